@@ -0,0 +1,98 @@
+import asyncio, hashlib, time
+from cachetools import TTLCache
+
+try:
+    # Optional: semantic lookup for near-identical phrasings
+    from fastembed import TextEmbedding
+    import numpy as np
+except ImportError:
+    TextEmbedding = None
+
+
+class LLMCache:
+    """
+    Caches LLM replies by transcript text.
+    Exact matches hit a SHA-256 keyed LRU; if fastembed is installed,
+    near-identical phrasings are matched by cosine similarity.
+    """
+
+    def __init__(self, model: str, maxsize: int = 1024, ttl: float = 600,
+                 threshold: float = 0.92, semantic: bool = True):
+        self.model = model
+        self.ttl = ttl
+        self.threshold = threshold
+        self._exact = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = asyncio.Lock()
+
+        # Embedding index: list of (vector, reply, expires_at).
+        # The model loads in the background on first use, not at import.
+        self._semantic = semantic and TextEmbedding is not None
+        self._embedder = None
+        self._loading = None
+        self._index = []
+        self._maxsize = maxsize
+        # Vectors from get() misses, reused by the set() that follows
+        self._pending = TTLCache(maxsize=maxsize, ttl=60)
+
+    @staticmethod
+    def _normalize(text: str) -> str:
+        return " ".join(text.lower().split()).strip(" .,!?")
+
+    def _key(self, text: str) -> str:
+        raw = f"{self.model}\x00{self._normalize(text)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _load_embedder(self):
+        try:
+            self._embedder = TextEmbedding("sentence-transformers/all-MiniLM-L6-v2")
+        except Exception as e:
+            print("Semantic cache disabled:", e)
+
+    def _ensure_embedder(self):
+        """Start loading the embedding model once; exact matches work meanwhile."""
+        if self._semantic and self._loading is None:
+            self._loading = asyncio.create_task(asyncio.to_thread(self._load_embedder))
+
+    async def _embed(self, text: str):
+        """Embed normalized text (unit length) off the event loop."""
+        def run():
+            vec = next(iter(self._embedder.embed([self._normalize(text)])))
+            return vec / np.linalg.norm(vec)
+        return await asyncio.to_thread(run)
+
+    async def get(self, text: str):
+        """Return a cached reply for `text`, or None on miss."""
+        key = self._key(text)
+        async with self._lock:
+            reply = self._exact.get(key)
+        self._ensure_embedder()
+        if reply is not None or self._embedder is None:
+            return reply
+
+        vec = await self._embed(text)
+        now = time.monotonic()
+        async with self._lock:
+            self._pending[key] = vec
+            self._index = [e for e in self._index if e[2] > now]
+            best, best_score = None, self.threshold
+            for emb, cached, _ in self._index:
+                score = float(np.dot(vec, emb))
+                if score >= best_score:
+                    best, best_score = cached, score
+        return best
+
+    async def set(self, text: str, reply: str):
+        """Store `reply` for `text`."""
+        key = self._key(text)
+        async with self._lock:
+            self._exact[key] = reply
+            vec = self._pending.pop(key, None)
+        if self._embedder is None:
+            return
+
+        if vec is None:
+            vec = await self._embed(text)
+        async with self._lock:
+            self._index.append((vec, reply, time.monotonic() + self.ttl))
+            if len(self._index) > self._maxsize:
+                self._index = self._index[-self._maxsize:]
@@ -1,11 +1,15 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, WebSocket
 from fastapi.responses import Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.routing import APIRouter
-import os, json, base64, asyncio, uuid, requests
+import os, re, asyncio, uuid
+import orjson
+from binascii import a2b_base64, b2a_base64
+import httpx
+from llm_cache import LLMCache
 from io import BytesIO
 from deepgram import DeepgramClient
-from deepgram import DeepgramClient, LiveOptions, LiveTranscriptionEvents, SpeakOptions
+from deepgram import DeepgramClient, DeepgramClientOptions, LiveOptions, LiveTranscriptionEvents
 
 
 app = FastAPI()
@@ -19,23 +23,54 @@ router = APIRouter()
 DEEPGRAM_API_KEY = os.getenv("DEEPGRAM_API_KEY")
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 PUBLIC_URL = os.getenv("PUBLIC_URL", "https://twiliotest-b4j9.onrender.com")
-deepgram = DeepgramClient(DEEPGRAM_API_KEY)
+# keepalive: idle pooled live sockets (and quiet callers) aren't closed by Deepgram
+deepgram = DeepgramClient(DEEPGRAM_API_KEY, DeepgramClientOptions(options={"keepalive": "true"}))
+DG_POOL_SIZE = int(os.getenv("DG_POOL_SIZE", "2"))  # warm Deepgram live sockets
+MEDIA_BATCH_FRAMES = 10  # 10 × 20ms Twilio frames per Deepgram send
+MEDIA_FRAME_BYTES = 160  # one 20ms Twilio frame of mu-law @ 8kHz
 
-@router.post("/twilio/voice")
-async def twilio_voice():
-    """
-    Twilio webhook: greets caller, starts audio stream to Deepgram,
-    and pauses to let the user respond.
-    """
-    # your deployed Render URL
-    stream_url = "wss://twiliotest-b4j9.onrender.com/audio"
+# Client-side endpointing: after this much caller silence, tell Deepgram to
+# finalize instead of waiting for its own endpointing
+SILENCE_BYTES = 3200     # 400ms of mu-law @ 8kHz
+VOICE_LEVEL = 8          # mean ULAW_LEVEL per sample (~512/32768, about -36 dBFS)
+
+def _ulaw_level(byte: int) -> int:
+    """|linear sample| of a G.711 mu-law byte, in units of 64 (capped at 255)."""
+    byte = ~byte & 0xFF
+    magnitude = (((byte & 0x0F) << 3) + 0x84 << ((byte >> 4) & 0x07)) - 0x84
+    return min(255, magnitude >> 6)
+
+# Lookup table so frame energy is bytes.translate + sum, both in C
+ULAW_LEVEL = bytes(_ulaw_level(b) for b in range(256))
+TTS_BATCH_BYTES = 1600   # ~200ms of mu-law @ 8kHz per outbound Twilio frame
+
+# Outbound media envelope has a fixed shape; only the base64 payload changes,
+# and base64 needs no JSON escaping, so frames are spliced instead of encoded
+MEDIA_PREFIX = '{"event":"media","media":{"payload":"'
+MEDIA_SUFFIX = '"}}'
+
+# Shared async HTTP client: keeps TCP/TLS sessions to Groq and Deepgram TTS
+# alive across calls (and across the pauses between replies)
+HTTP = httpx.AsyncClient(
+    http2=True,
+    timeout=30,
+    limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60),
+)
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await HTTP.aclose()
+
+# ======== TWIML ========
+# Built once at import: only depends on PUBLIC_URL, which is fixed per deploy
+STREAM_URL = PUBLIC_URL.replace("https://", "wss://", 1).rstrip("/") + "/audio"
 
-    # ✅ TwiML with stream opened *before* greeting
-    twiml = f"""<?xml version="1.0" encoding="UTF-8"?>
+# ✅ TwiML with stream opened *before* greeting
+TWIML = f"""<?xml version="1.0" encoding="UTF-8"?>
 <Response>
     <!-- Step 1: Start audio stream immediately -->
     <Start>
-        <Stream url="{stream_url}"
+        <Stream url="{STREAM_URL}"
                 content-type="audio/ulaw"
                 track="both_tracks">
             <Parameter name="caller" value="+18702735332"/>
@@ -55,44 +90,182 @@ async def twilio_voice():
     <!-- Step 4: Graceful end if no further input -->
     <Say>Thank you for calling. Goodbye!</Say>
     <Hangup/>
-</Response>"""
+</Response>""".encode("utf-8")
 
-    return Response(content=twiml, media_type="application/xml")
+@router.post("/twilio/voice")
+async def twilio_voice():
+    """
+    Twilio webhook: greets caller, starts audio stream to Deepgram,
+    and pauses to let the user respond.
+    """
+    return Response(content=TWIML, media_type="application/xml")
 
 
 # ======== AI PIPELINE ========
-async def generate_ai_reply(text: str) -> str:
-    """Send transcript to Groq and return text reply."""
+GROQ_MODEL = "llama3-70b-8192"  # or "llama3-8b"
+
+# Repeated phrases ("hello", "repeat that") skip the Groq round-trip.
+# Replies are sampled at temperature 0.7, so keep the TTL short.
+reply_cache = LLMCache(model=GROQ_MODEL, ttl=600)
+
+GROQ_URL = "https://api.groq.com/openai/v1/chat/completions"
+FALLBACK_REPLY = "Sorry, I had trouble processing that."
+# Split after . ! ? when a capital or a list number ("2. ") follows, except after
+# common titles/abbreviations and list numbers themselves: keeps "9 a.m. to 5 p.m.",
+# "Dr. Smith" and "1. Go." whole
+_NO_BREAK = ("Mr", "Mrs", "Ms", "Dr", "Prof", "St", "Jr", "Sr", r"e\.g", r"i\.e", r"\d", r"\d\d")
+SENTENCE_END = re.compile(
+    r"(?<=[.!?])" + "".join(rf"(?<!\b{w}\.)" for w in _NO_BREAK) + r"\s+(?=[A-Z]|\d+\.\s)"
+)
+
+async def stream_ai_reply(text: str):
+    """Stream the Groq reply to a transcript, yielding text deltas as they arrive."""
+    cached = await reply_cache.get(text)
+    if cached:
+        yield cached
+        return
+
     headers = {"Authorization": f"Bearer {GROQ_API_KEY}"}
     payload = {
-        "model": "llama3-70b-8192",  # or "llama3-8b"
+        "model": GROQ_MODEL,
         "messages": [{"role": "user", "content": text}],
         "temperature": 0.7,
+        "stream": True,
     }
-    r = requests.post(
-        "https://api.groq.com/openai/v1/chat/completions",
-        json=payload,
-        headers=headers,
-        timeout=30,
-    )
-    if r.status_code != 200:
-        print("Groq error:", r.text)
-        return "Sorry, I had trouble processing that."
-    return r.json()["choices"][0]["message"]["content"]
+    parts = []
+    done = False
+    async with HTTP.stream("POST", GROQ_URL, json=payload, headers=headers) as r:
+        if r.status_code != 200:
+            print("Groq error:", (await r.aread()).decode("utf-8", "replace"))
+            yield FALLBACK_REPLY
+            return
+        # Server-sent events: "data: {...}" lines, terminated by "data: [DONE]"
+        async for line in r.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            data = line[6:]
+            if data == "[DONE]":
+                done = True
+                break
+            delta = orjson.loads(data)["choices"][0]["delta"].get("content")
+            if delta:
+                parts.append(delta)
+                yield delta
+    # Only cache complete replies; a stream cut off before [DONE] is partial
+    if done and parts:
+        await reply_cache.set(text, "".join(parts))
+
+async def split_sentences(deltas):
+    """Regroup streamed text deltas into complete sentences."""
+    pending = ""
+    async for delta in deltas:
+        pending += delta
+        *sentences, pending = SENTENCE_END.split(pending)
+        for sentence in sentences:
+            if sentence.strip():
+                yield sentence.strip()
+    if pending.strip():
+        yield pending.strip()
+
+async def generate_ai_reply(text: str) -> str:
+    """Send transcript to Groq and return text reply."""
+    return "".join([delta async for delta in stream_ai_reply(text)])
+
+# Deepgram TTS over the shared HTTP client, so replies reuse a warm connection
+# instead of paying a TCP+TLS handshake per sentence (raw mu-law for Twilio)
+TTS_URL = "https://api.deepgram.com/v1/speak"
+TTS_PARAMS = {"model": "aura-asteria-en", "encoding": "mulaw", "sample_rate": 8000, "container": "none"}
+
+async def warm_tts_connection():
+    """Open (or keep fresh) the pooled Deepgram connection; the response itself is ignored."""
+    try:
+        await HTTP.head(TTS_URL)
+    except Exception as e:
+        print("TTS warm-up error:", e)
 
 async def synthesize_tts(text: str) -> bytes:
     """Convert text → mu-law audio bytes."""
     try:
-        buffer = bytearray()
-        options = SpeakOptions(model="aura-asteria-en", encoding="mulaw", sample_rate=8000)
-        speak = deepgram.speak.v("1").stream({"text": text}, options)
-        for chunk in speak:
-            buffer.extend(chunk)
-        return bytes(buffer)
+        r = await HTTP.post(
+            TTS_URL,
+            params=TTS_PARAMS,
+            json={"text": text},
+            headers={"Authorization": f"Token {DEEPGRAM_API_KEY}"},
+        )
+        if r.status_code != 200:
+            print("TTS error:", r.text)
+            return b""
+        return r.content
     except Exception as e:
         print("TTS error:", e)
         return b""
 
+# ======== DEEPGRAM LIVE POOL ========
+LIVE_OPTIONS = LiveOptions(model="nova-2", encoding="mulaw", sample_rate=8000)
+LIVE_EVENTS = (LiveTranscriptionEvents.Transcript,)
+
+# Started sockets waiting for a call, so callers skip the Deepgram handshake.
+# Each entry is (dg_socket, handlers); a call fills in handlers for LIVE_EVENTS.
+dg_pool = asyncio.Queue()
+_refills = set()  # strong refs so background refill tasks aren't collected
+
+def _open_live_socket():
+    """Open and start a Deepgram live connection (blocking)."""
+    dg_socket = deepgram.listen.live.v("1")
+    handlers = {}
+
+    def route(event):
+        def dispatch(*args, **kwargs):
+            handler = handlers.get(event)
+            if handler:
+                handler(*args, **kwargs)
+        return dispatch
+
+    for event in LIVE_EVENTS:
+        dg_socket.on(event, route(event))
+    dg_socket.on(LiveTranscriptionEvents.Open, lambda *_, **__: print("🎧 Deepgram connected"))
+    dg_socket.on(LiveTranscriptionEvents.Close, lambda *_, **__: print("👋 Deepgram closed"))
+    dg_socket.on(LiveTranscriptionEvents.Error, lambda *_, **__: print("❌ Deepgram error"))
+    if not dg_socket.start(LIVE_OPTIONS):
+        raise RuntimeError("Deepgram live socket failed to start")
+    return dg_socket, handlers
+
+async def refill_live_pool():
+    try:
+        dg_pool.put_nowait(await asyncio.to_thread(_open_live_socket))
+    except Exception as e:
+        print("Deepgram pool refill error:", e)
+
+def top_up_live_pool():
+    """Start refills until pooled + in-flight sockets reach DG_POOL_SIZE."""
+    while dg_pool.qsize() + len(_refills) < DG_POOL_SIZE:
+        task = asyncio.create_task(refill_live_pool())
+        _refills.add(task)
+        task.add_done_callback(_refills.discard)
+
+async def acquire_live_socket():
+    """Take a healthy warm socket from the pool (or open one) and top the pool back up."""
+    try:
+        while not dg_pool.empty():
+            dg_socket, handlers = dg_pool.get_nowait()
+            if dg_socket.is_connected():
+                return dg_socket, handlers
+            await asyncio.to_thread(dg_socket.finish)
+        return await asyncio.to_thread(_open_live_socket)
+    finally:
+        top_up_live_pool()
+
+@app.on_event("startup")
+async def warm_live_pool():
+    top_up_live_pool()
+    await asyncio.gather(*list(_refills))
+
+@app.on_event("shutdown")
+async def drain_live_pool():
+    while not dg_pool.empty():
+        dg_socket, _ = dg_pool.get_nowait()
+        await asyncio.to_thread(dg_socket.finish)
+
 # ======== WEBSOCKET HANDLER ========
 @app.websocket("/audio")
 async def audio_stream(websocket: WebSocket):
@@ -100,98 +273,189 @@ async def audio_stream(websocket: WebSocket):
     await websocket.accept()
     print("✅ WebSocket connected")
 
-    dg_socket = deepgram.listen.live.v("1")
-    
+    # Used sockets are finished, not returned: no transcript state bleeds between calls
+    try:
+        dg_socket, dg_handlers = await acquire_live_socket()
+    except Exception as e:
+        print("Deepgram connect error:", e)
+        await websocket.close()
+        return
+
     # Capture the running event loop for thread-safe scheduling
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
     stream_sid = None
+    media_prefix = None  # MEDIA_PREFIX with this stream's streamSid, set on "start"
 
     # ---- Process Transcript ----
     async def process_transcript(transcript):
-        nonlocal stream_sid
         transcript = transcript.strip()
         if not transcript:
             return
         print(f"🗣️ Heard: {transcript}")
 
-        # Generate AI reply
-        ai_reply = await generate_ai_reply(transcript)
-        print(f"🤖 AI: {ai_reply}")
+        # Do the Deepgram TCP+TLS handshake now, while Groq is still generating
+        warmup = asyncio.create_task(warm_tts_connection())
+
+        async def send_audio(audio):
+            if media_prefix:
+                # Package audio for Twilio in the correct format
+                payload = b2a_base64(audio, newline=False).decode("ascii")
+                await websocket.send_text(media_prefix + payload + MEDIA_SUFFIX)
+
+        # Start TTS for each sentence as soon as Groq finishes it,
+        # while an ordered sender plays them back in sequence.
+        # Bounded so synthesis runs at most two sentences ahead of playback.
+        tts_tasks = asyncio.Queue(maxsize=2)
 
-        # Stream TTS audio back to Twilio in small packets (real-time playback)
+        async def synthesize_sentences():
+            try:
+                async for sentence in split_sentences(stream_ai_reply(transcript)):
+                    print(f"🤖 AI: {sentence}")
+                    # Let TTS reuse the warmed connection rather than race it with a second one
+                    await warmup
+                    await tts_tasks.put(asyncio.create_task(synthesize_tts(sentence)))
+            except Exception as e:
+                print("Groq streaming error:", e)
+            finally:
+                await tts_tasks.put(None)
+
+        producer = asyncio.create_task(synthesize_sentences())
         try:
-            options = SpeakOptions(model="aura-asteria-en", encoding="mulaw", sample_rate=8000)
-            stream = deepgram.speak.v("1").stream({"text": ai_reply}, options)
-            
-            for chunk in stream:
-                if stream_sid:
-                    # Package audio for Twilio in the correct format
-                    payload = base64.b64encode(chunk).decode("utf-8")
-                    await websocket.send_json({
-                        "streamId": stream_sid,
-                        "event": "media",
-                        "media": {
-                            "payload": payload
-                        }
-                    })
-                await asyncio.sleep(0.01)  # Small delay for Twilio buffer
-
-            # ⏸️ Brief pause before allowing next user input
-            await asyncio.sleep(0.5)
+            # Twilio buffers playback, so send without pacing and track when it ends:
+            # mu-law @ 8kHz is exactly 8000 bytes/sec
+            playback_end = loop.time()
+            while (task := await tts_tasks.get()) is not None:
+                audio = memoryview(await task)
+                for i in range(0, len(audio), TTS_BATCH_BYTES):
+                    await send_audio(audio[i:i + TTS_BATCH_BYTES])
+                playback_end = max(playback_end, loop.time()) + len(audio) / 8000
+
+            # ⏸️ Hold the next reply until the caller has heard this one
+            await asyncio.sleep(max(0, playback_end - loop.time()))
             print("🎧 Finished streaming reply audio to Twilio")
         except Exception as e:
             print("TTS streaming error:", e)
+        finally:
+            warmup.cancel()
+            producer.cancel()
+            while not tts_tasks.empty():
+                task = tts_tasks.get_nowait()
+                if task is not None:
+                    task.cancel()
+
+    # ---- Transcript Queue ----
+    # One worker per call so replies never overlap on the Twilio socket
+    transcripts = asyncio.Queue(maxsize=4)
+
+    def enqueue_transcript(transcript):
+        try:
+            transcripts.put_nowait(transcript)
+        except asyncio.QueueFull:
+            print(f"⚠️ Dropping transcript, reply queue full: {transcript}")
+
+    async def transcript_worker():
+        while True:
+            transcript = await transcripts.get()
+            try:
+                await process_transcript(transcript)
+            except Exception as e:
+                print("Error in process_transcript:", e)
+
+    worker = asyncio.create_task(transcript_worker())
 
     # ---- Deepgram Transcript Event ----
     def on_transcript(_, result, **kwargs):
         try:
             alt = result.channel.alternatives[0]
             if alt.transcript and getattr(result, "is_final", False):
-                # ✅ Schedule the coroutine on the main event loop from the background thread
-                loop.call_soon_threadsafe(asyncio.create_task, process_transcript(alt.transcript))
+                # ✅ Hand off to the main event loop from the background thread
+                loop.call_soon_threadsafe(enqueue_transcript, alt.transcript)
         except Exception as e:
             print("Transcript error:", e)
 
 
     # ---- Deepgram Events ----
-    dg_socket.on(LiveTranscriptionEvents.Open, lambda *_: print("🎧 Deepgram connected"))
-    dg_socket.on(LiveTranscriptionEvents.Close, lambda *_: print("👋 Deepgram closed"))
-    dg_socket.on(LiveTranscriptionEvents.Error, lambda *_: print("❌ Deepgram error"))
-    dg_socket.on(LiveTranscriptionEvents.Transcript, on_transcript)
+    dg_handlers[LiveTranscriptionEvents.Transcript] = on_transcript
+
+    # ---- Utterance End ----
+    # Caller went quiet: flush pending audio and have Deepgram finalize now
+    closed = False  # set once the call is torn down and dg_socket is finishing
+
+    def finalize_utterance():
+        if closed:
+            return
+        flush_audio()
+        dg_socket.finalize()
 
-    # Start streaming to Deepgram
-    dg_socket.start(LiveOptions(model="nova-2", encoding="mulaw", sample_rate=8000))
+    # Twilio sends ~20ms frames; forward ~200ms batches to Deepgram instead.
+    # Fixed-size buffer + write offset, so the 50 Hz loop never reallocates it.
+    capacity = MEDIA_BATCH_FRAMES * MEDIA_FRAME_BYTES
+    audio_view = memoryview(bytearray(capacity))
+    buffered = 0
+    speaking = False
+    silent = 0  # bytes of silence since the caller last spoke
+
+    # Bind hot-path lookups once; the loop below runs ~50×/sec per call
+    dg_send = dg_socket.send
+    loads = orjson.loads
+    decode = a2b_base64
+
+    def flush_audio():
+        nonlocal buffered
+        if buffered:
+            dg_send(bytes(audio_view[:buffered]))
+        buffered = 0
 
     try:
-        while True:
-            message = await websocket.receive()
-            data = message.get("text") or message.get("bytes")
-
-            if isinstance(data, str):
-                event = json.loads(data)
-                event_type = event.get("event")
-                
-                if event_type == "start":
-                    stream_sid = event.get("start", {}).get("streamSid")
-                    print(f"📞 Stream started: {stream_sid}")
-                    
-                elif event_type == "media":
-                    audio_payload = base64.b64decode(event["media"]["payload"])
-                    dg_socket.send(audio_payload)
-                    
-                elif event_type == "stop":
-                    print("🛑 Twilio stopped")
-                    break
-                    
-            elif isinstance(data, (bytes, bytearray)):
-                dg_socket.send(data)
-
-            await asyncio.sleep(0.01)
-
-    except WebSocketDisconnect:
-        print("❌ WebSocket disconnected")
+        # Twilio only sends JSON text frames; iteration ends on disconnect
+        async for data in websocket.iter_text():
+            event = loads(data)
+            event_type = event.get("event")
+
+            # Media is by far the most frequent event, so test it first
+            if event_type == "media":
+                media = event["media"]
+                chunk = decode(media["payload"])
+                end = buffered + len(chunk)
+                if end <= capacity:
+                    audio_view[buffered:end] = chunk
+                    buffered = end
+                    if end == capacity:
+                        flush_audio()
+                else:
+                    # Frame doesn't fit: flush what we have and send it as-is
+                    flush_audio()
+                    dg_send(chunk)
+
+                # Endpoint on the caller only: with both_tracks, outbound frames
+                # carry our own TTS audio and would double-count silence
+                if media.get("track", "inbound") == "inbound":
+                    if sum(chunk.translate(ULAW_LEVEL)) > VOICE_LEVEL * len(chunk):
+                        speaking, silent = True, 0
+                    elif speaking:
+                        silent += len(chunk)
+                        if silent >= SILENCE_BYTES:
+                            speaking = False
+                            finalize_utterance()
+
+            elif event_type == "start":
+                stream_sid = event.get("start", {}).get("streamSid")
+                if stream_sid:
+                    media_prefix = f'{{"streamSid":"{stream_sid}",' + MEDIA_PREFIX[1:]
+                print(f"📞 Stream started: {stream_sid}")
+
+            elif event_type == "stop":
+                print("🛑 Twilio stopped")
+                flush_audio()
+                break
+        else:
+            print("❌ WebSocket disconnected")
     finally:
-        dg_socket.finish()
+        worker.cancel()
+        flush_audio()
+        closed = True
+        # finish() joins the SDK's listen/keepalive threads; keep it off the event loop
+        await asyncio.to_thread(dg_socket.finish)
         print("✅ Deepgram finished")
 
 
@@ -205,14 +469,22 @@ async def process_transcript(text: str, websocket: WebSocket):
         print(f"🤖 AI: {ai_reply}")
         audio_bytes = await synthesize_tts(ai_reply)
         if audio_bytes:
-            payload = base64.b64encode(audio_bytes).decode("utf-8")
-            await websocket.send_json({
-                "event": "media",
-                "media": {"payload": payload}
-            })
+            payload = b2a_base64(audio_bytes, newline=False).decode("ascii")
+            await websocket.send_text(MEDIA_PREFIX + payload + MEDIA_SUFFIX)
             print("🎧 Sent synthesized audio to Twilio")
     except Exception as e:
         print("Error in process_transcript:", e)
 
 # ======== REGISTER ROUTES ========
-app.include_router(router)
\ No newline at end of file
+app.include_router(router)
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
+    )